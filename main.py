@@ -1,30 +1,63 @@
+import codecs
 import io
 import os
 import csv
 import datetime
+import functools
+import hashlib
+import operator
 import smtplib
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from email.message import EmailMessage
-from typing import List, Dict, Optional
+from typing import BinaryIO, Collection, Iterator, List, Dict, Optional, Set, Tuple
 
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException
+import orjson
+from fastapi import FastAPI, File, Form, Request, UploadFile, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse
 
-try:
-    from reportlab.lib.pagesizes import letter, landscape
-    from reportlab.platypus import Table, TableStyle, SimpleDocTemplate
-    from reportlab.lib import colors
-    REPORTLAB_AVAILABLE = True
-except Exception:
-    REPORTLAB_AVAILABLE = False
+# Export backends are imported on first use, so workers that only ever serve
+# CSV/JSON never load them. Each loader returns None when the package is missing.
+
+@functools.cache
+def _reportlab():
+    try:
+        from reportlab.lib.pagesizes import letter, landscape
+        from reportlab.platypus import LongTable, TableStyle, SimpleDocTemplate
+        from reportlab.lib import colors
+    except Exception:
+        return None
+    return letter, landscape, LongTable, TableStyle, SimpleDocTemplate, colors
+
+
+@functools.cache
+def _openpyxl_workbook():
+    try:
+        from openpyxl import Workbook
+    except Exception:
+        return None
+    return Workbook
 
-try:
-    from openpyxl import Workbook
-    OPENPYXL_AVAILABLE = True
-except Exception:
-    OPENPYXL_AVAILABLE = False
 
-app = FastAPI(title="Missing 945 API", version="1.0.0")
+@functools.cache
+def _xlsxwriter():
+    try:
+        import xlsxwriter
+    except Exception:
+        return None
+    return xlsxwriter
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    close_smtp()
+
+
+app = FastAPI(title="Missing 945 API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,73 +69,155 @@ app.add_middleware(
 
 # ---------- CSV helpers (no pandas) ----------
 
-def load_csv_bytes(b: bytes) -> List[Dict[str, str]]:
-    """Parse CSV bytes to a list of dict rows. Tries common encodings."""
+# One report row: values in REPORT_COLUMNS order
+ReportRow = Tuple[str, ...]
+
+SNIFF_SIZE = 64 * 1024
+
+
+def _sniff_encoding(f: BinaryIO) -> str:
+    """Pick an encoding from the BOM or a utf-8 check of the first SNIFF_SIZE bytes."""
+    f.seek(0)
+    head = f.read(SNIFF_SIZE)
+    f.seek(0)
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # final=False tolerates a multi-byte character cut at the prefix end
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return "latin1"
+    return "utf-8"
+
+
+def load_csv_stream(f: BinaryIO, usecols: Optional[Collection[str]] = None) -> Tuple[List[Dict[str, str]], Set[str]]:
+    """Parse a binary CSV file object to dict rows plus the set of trimmed headers.
+
+    Text is decoded incrementally from the file, so the upload is never held
+    in memory as a whole bytes/str copy. The file is left open at offset 0.
+    When usecols is given, rows only carry those columns (when present); the
+    returned header set still lists every column in the file.
+    """
+    encodings = [_sniff_encoding(f)]
+    if encodings[0] == "utf-8":
+        # Only the prefix was checked; fall back if later bytes are not utf-8
+        encodings.append("latin1")
+    # Before Python 3.11 SpooledTemporaryFile lacks readable()/seekable(), which
+    # TextIOWrapper needs; only then wrap the BytesIO/temp file it spools into
+    raw_file = f if hasattr(f, "readable") and hasattr(f, "seekable") else f._file
     last_err = None
-    for enc in ("utf-8", "utf-8-sig", "utf-16", "latin1"):
+    for enc in encodings:
+        f.seek(0)
+        text = None
         try:
-            text = b.decode(enc)
-            # Normalize newlines
-            f = io.StringIO(text)
-            reader = csv.DictReader(f)
-            # Trim headers
-            fieldnames = [str(h).strip() for h in (reader.fieldnames or [])]
+            text = io.TextIOWrapper(raw_file, encoding=enc, newline="")
+            reader = csv.reader(text)
+            # Trim headers once instead of per row
+            fieldnames = [str(h).strip() for h in next(reader, [])]
+            width = len(fieldnames)
+            pad = [""] * width
+            if usecols is None:
+                keep = None
+                names = fieldnames
+            else:
+                keep = [i for i, h in enumerate(fieldnames) if h in usecols]
+                names = [fieldnames[i] for i in keep]
             rows: List[Dict[str, str]] = []
             for raw in reader:
-                row = {}
-                for k, v in raw.items():
-                    if k is None:
-                        continue
-                    row[str(k).strip()] = (v if v is not None else "").strip()
-                rows.append(row)
-            # Re-map to trimmed headers if needed
-            if reader.fieldnames and any(h != str(h).strip() for h in reader.fieldnames):
-                remapped = []
-                for r in rows:
-                    nr = {}
-                    for k, v in r.items():
-                        nr[str(k).strip()] = v
-                    remapped.append(nr)
-                rows = remapped
-            return rows
+                if not raw:
+                    continue
+                if len(raw) < width:
+                    raw = raw + pad[len(raw):]
+                if keep is not None:
+                    raw = [raw[i] for i in keep]
+                rows.append(dict(zip(names, map(str.strip, raw))))
+            return rows, set(fieldnames)
         except Exception as e:
             last_err = e
             continue
+        finally:
+            # Detach so closing the wrapper does not close the upload
+            if text is not None:
+                text.detach()
+            f.seek(0)
     raise HTTPException(status_code=400, detail=f"CSV read error: {last_err}")
 
 
-def to_xlsx_bytes(rows: List[Dict[str, str]], columns: List[str]) -> bytes:
-    if not OPENPYXL_AVAILABLE:
+def to_xlsx_bytes(rows: List[ReportRow], columns: List[str]) -> bytes:
+    xlsxwriter = _xlsxwriter()
+    if xlsxwriter is not None:
+        buf = io.BytesIO()
+        # constant_memory flushes each row to a temp file as soon as the next
+        # one starts; in_memory would silently turn it off again. Values are
+        # written as plain strings, as openpyxl did, never turned into links.
+        wb = xlsxwriter.Workbook(buf, {"constant_memory": True, "strings_to_urls": False})
+        ws = wb.add_worksheet()
+        ws.write_row(0, 0, columns)
+        for i, r in enumerate(rows, 1):
+            # write_row stops at the first cell it cannot write (e.g. a value over
+            # Excel's 32,767 character limit) and reports it only via the return code
+            if ws.write_row(i, 0, r) != 0:
+                raise HTTPException(status_code=500, detail=f"Excel export failed at report row {i}; try csv")
+        wb.close()
+        return buf.getvalue()
+    Workbook = _openpyxl_workbook()
+    if Workbook is None:
         raise HTTPException(status_code=500, detail="Excel export not available")
-    wb = Workbook()
-    ws = wb.active
+    # write_only streams rows to the sheet XML instead of keeping Cell objects
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
     ws.append(columns)
     for r in rows:
-        ws.append([r.get(c, "") for c in columns])
+        ws.append(r)
     buf = io.BytesIO()
     wb.save(buf)
     buf.seek(0)
     return buf.getvalue()
 
 
-def to_csv_bytes(rows: List[Dict[str, str]], columns: List[str]) -> bytes:
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def iter_csv_chunks(rows: List[ReportRow], columns: List[str]) -> Iterator[bytes]:
+    """Yield the CSV export as utf-8 chunks of roughly CSV_CHUNK_SIZE characters."""
     buf = io.StringIO()
-    writer = csv.DictWriter(buf, fieldnames=columns, extrasaction='ignore')
-    writer.writeheader()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
     for r in rows:
-        writer.writerow({c: r.get(c, "") for c in columns})
-    return buf.getvalue().encode("utf-8")
+        writer.writerow(r)
+        if buf.tell() >= CSV_CHUNK_SIZE:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def to_csv_bytes(rows: List[ReportRow], columns: List[str]) -> bytes:
+    return b"".join(iter_csv_chunks(rows, columns))
 
 
-def to_pdf_bytes(rows: List[Dict[str, str]], columns: List[str]) -> bytes:
-    if not REPORTLAB_AVAILABLE:
+def to_json_bytes(rows: List[ReportRow], columns: List[str], filename: str) -> bytes:
+    return orjson.dumps({
+        "filename": filename,
+        "rows": [dict(zip(columns, r)) for r in rows],
+    })
+
+
+def to_pdf_bytes(rows: List[ReportRow], columns: List[str]) -> bytes:
+    reportlab = _reportlab()
+    if reportlab is None:
         raise HTTPException(status_code=500, detail="PDF export not available")
+    letter, landscape, LongTable, TableStyle, SimpleDocTemplate, colors = reportlab
     buf = io.BytesIO()
     doc = SimpleDocTemplate(buf, pagesize=landscape(letter), leftMargin=12, rightMargin=12, topMargin=12, bottomMargin=12)
     # Limit rows for readability
     preview = rows[:200]
-    data = [columns] + [[str(r.get(c, "")) for c in columns] for r in preview]
-    table = Table(data, repeatRows=1)
+    # Parsed CSV values are already strings, so no str() per cell
+    data = [list(columns)]
+    data.extend(list(r) for r in preview)
+    table = LongTable(data, repeatRows=1, splitByRow=True)
     style = TableStyle([
         ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#111827")),
         ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
@@ -121,119 +236,255 @@ def to_pdf_bytes(rows: List[Dict[str, str]], columns: List[str]) -> bytes:
 
 # ---------- Domain logic (no pandas) ----------
 
-def build_report_rows(shipment_history: UploadFile, edib2bi: UploadFile, edi940: UploadFile) -> List[Dict[str, str]]:
-    df1 = load_csv_bytes(shipment_history.file.read())
-    shipment_history.file.seek(0)
-    df2 = load_csv_bytes(edib2bi.file.read())
-    edib2bi.file.seek(0)
-    df3 = load_csv_bytes(edi940.file.read())
-    edi940.file.seek(0)
+# Final report column order
+REPORT_COLUMNS = [
+    'Pickticket','Warehouse','Order','Drop Date','Ship Date','Ship To',
+    'Ship State','Zip Code','Customer PO','Ship Via','Load ID','Weight','SKU','Units','Price','Size Type','Size','Product Type',
+    'Received in EDI?','EDI Processing Status','EDI Message',
+    'Found in AX DATa?','SalesHeaderStatus','SalesHeaderDocStatus','PickModeOfDelivery','PickCreatedDate','DeliveryDate'
+]
+
+# Shipment_History columns copied as-is; they lead every report row
+SHIP_COLUMNS = (
+    'Pickticket','Warehouse','Order','Drop Date','Ship Date','Ship To',
+    'Ship State','Zip Code','Customer PO','Ship Via','Load ID','Weight','SKU','Units','Price','Size Type','Size','Product Type',
+)
+
+# Low-cardinality shipment columns; equal values share one string object
+INTERN_SHIP_COLUMNS = ('Warehouse', 'Ship Via', 'Size Type', 'Product Type')
 
-    # Required columns
-    def has_col(rows: List[Dict[str, str]], col: str) -> bool:
-        return any(col in r for r in rows) or (len(rows) == 0)
+# Columns actually read from each upload; everything else is dropped at parse time
+EDI_COLUMNS = ('InvoiceNumber', 'StatusSummary', 'ERRORDESCRIPTION')
+SHIP_USECOLS = frozenset(SHIP_COLUMNS + EDI_COLUMNS)
+EDIB2BI_USECOLS = frozenset(('AXReferenceID',) + EDI_COLUMNS)
+EDI940_USECOLS = frozenset((
+    'PickRoute', 'SalesHeaderStatus', 'SalesHeaderDocStatus', 'PickModeOfDelivery', 'PickCreatedDate', 'DeliveryDate',
+))
 
-    if not has_col(df1, "Pickticket"):
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+def build_report_rows(shipment_history: UploadFile, edib2bi: UploadFile, edi940: UploadFile) -> List[ReportRow]:
+    df1, fields1 = load_csv_stream(shipment_history.file, SHIP_USECOLS)
+    df2, fields2 = load_csv_stream(edib2bi.file, EDIB2BI_USECOLS)
+    df3, fields3 = load_csv_stream(edi940.file, EDI940_USECOLS)
+
+    # Required columns. Every row carries the full header, so check that only.
+    def has_col(rows: List[Dict[str, str]], fields: Set[str], col: str) -> bool:
+        return col in fields or not rows
+
+    if not has_col(df1, fields1, "Pickticket"):
         raise HTTPException(status_code=400, detail=f"Missing column 'Pickticket' in Shipment_History___Total")
-    if not has_col(df2, "AXReferenceID"):
+    if not has_col(df2, fields2, "AXReferenceID"):
         raise HTTPException(status_code=400, detail=f"Missing column 'AXReferenceID' in EDIB2BiReportV2")
-    if not has_col(df3, "PickRoute"):
+    if not has_col(df3, fields3, "PickRoute"):
         raise HTTPException(status_code=400, detail=f"Missing column 'PickRoute' in EDI940Report_withCostV2.0")
 
-    # Index for joins
-    by_ax = {r.get("AXReferenceID", ""): r for r in df2}
-    by_pickroute = {r.get("PickRoute", ""): r for r in df3}
-
-    # First join: df1 left join df2 on Pickticket = AXReferenceID
-    merged = []
-    for r1 in df1:
-        key = r1.get("Pickticket", "")
-        r2 = by_ax.get(key, {})
-        merged_row = {
-            'Warehouse': r1.get('Warehouse', ''),
-            'Pickticket': r1.get('Pickticket', ''),
-            'Order': r1.get('Order', ''),
-            'Drop Date': r1.get('Drop Date', ''),
-            'Ship Date': r1.get('Ship Date', ''),
-            'Ship To': r1.get('Ship To', ''),
-            'Ship State': r1.get('Ship State', ''),
-            'Zip Code': r1.get('Zip Code', ''),
-            'Customer PO': r1.get('Customer PO', ''),
-            'Ship Via': r1.get('Ship Via', ''),
-            'Load ID': r1.get('Load ID', ''),
-            'Weight': r1.get('Weight', ''),
-            'SKU': r1.get('SKU', ''),
-            'Units': r1.get('Units', ''),
-            'Price': r1.get('Price', ''),
-            'Size Type': r1.get('Size Type', ''),
-            'Size': r1.get('Size', ''),
-            'Product Type': r1.get('Product Type', ''),
-            'InvoiceNumber': r2.get('InvoiceNumber', r1.get('InvoiceNumber', '')),
-            'StatusSummary': r2.get('StatusSummary', r1.get('StatusSummary', '')),
-            'ERRORDESCRIPTION': r2.get('ERRORDESCRIPTION', r1.get('ERRORDESCRIPTION', '')),
-        }
-        merged.append(merged_row)
-
-    # Second join: merged left join df3 on Pickticket = PickRoute
-    final_rows = []
-    for r in merged:
-        r3 = by_pickroute.get(r.get('Pickticket', ''), {})
-        out = {
-            'Pickticket': r.get('Pickticket', ''),
-            'Warehouse': r.get('Warehouse', ''),
-            'Order': r.get('Order', ''),
-            'Drop Date': r.get('Drop Date', ''),
-            'Ship Date': r.get('Ship Date', ''),
-            'Ship To': r.get('Ship To', ''),
-            'Ship State': r.get('Ship State', ''),
-            'Zip Code': r.get('Zip Code', ''),
-            'Customer PO': r.get('Customer PO', ''),
-            'Ship Via': r.get('Ship Via', ''),
-            'Load ID': r.get('Load ID', ''),
-            'Weight': r.get('Weight', ''),
-            'SKU': r.get('SKU', ''),
-            'Units': r.get('Units', ''),
-            'Price': r.get('Price', ''),
-            'Size Type': r.get('Size Type', ''),
-            'Size': r.get('Size', ''),
-            'Product Type': r.get('Product Type', ''),
-            'InvoiceNumber': r.get('InvoiceNumber', ''),
-            'StatusSummary': r.get('StatusSummary', ''),
-            'ERRORDESCRIPTION': r.get('ERRORDESCRIPTION', ''),
-            'PickRoute': r3.get('PickRoute', ''),
-            'SalesHeaderStatus': r3.get('SalesHeaderStatus', ''),
-            'SalesHeaderDocStatus': r3.get('SalesHeaderDocStatus', ''),
-            'PickModeOfDelivery': r3.get('PickModeOfDelivery', ''),
-            'PickCreatedDate': r3.get('PickCreatedDate', ''),
-            'DeliveryDate': r3.get('DeliveryDate', ''),
-        }
-        final_rows.append(out)
-
-    # Rename columns
-    for r in final_rows:
-        r['Received in EDI?'] = r.pop('InvoiceNumber', '')
-        r['EDI Processing Status'] = r.pop('StatusSummary', '')
-        r['EDI Message'] = r.pop('ERRORDESCRIPTION', '')
-        r['Found in AX DATa?'] = r.pop('PickRoute', '')
-
-    # Filter
-    filtered = []
-    for r in final_rows:
-        doc = r.get('SalesHeaderDocStatus')
-        proc = r.get('EDI Processing Status')
-        if (doc is None or proc is None) or (doc in ['Picking List'] and proc in ['AX Load Failure']):
-            filtered.append(r)
-
-    # Dedupe by Pickticket
+    # Index for joins. Keep only the columns the report reads, not the whole
+    # row; df2 values stay None when the column is absent so df1 can fill in.
+    by_ax = {
+        r.get("AXReferenceID", ""): (r.get('InvoiceNumber'), _intern(r.get('StatusSummary')), r.get('ERRORDESCRIPTION'))
+        for r in df2
+    }
+    by_pickroute = {
+        r.get("PickRoute", ""): (
+            r.get('PickRoute', ''),
+            sys.intern(r.get('SalesHeaderStatus', '')),
+            sys.intern(r.get('SalesHeaderDocStatus', '')),
+            r.get('PickModeOfDelivery', ''),
+            r.get('PickCreatedDate', ''),
+            r.get('DeliveryDate', ''),
+        )
+        for r in df3
+    }
+    no_ax = (None, None, None)
+    no_pickroute = ('', '', '', '', '', '')
+
+    # itemgetter needs every key present; only backfill when the header lacks some
+    missing = [c for c in SHIP_COLUMNS if c not in fields1]
+    if missing:
+        defaults = dict.fromkeys(missing, '')
+        for r1 in df1:
+            r1.update(defaults)
+    get_ship = operator.itemgetter(*SHIP_COLUMNS)
+
+    # Single pass over df1: both left joins, rename, filter and dedupe by Pickticket
     seen = set()
-    deduped = []
-    for r in filtered:
-        pt = r.get('Pickticket', '')
-        if pt not in seen:
-            seen.add(pt)
-            deduped.append(r)
+    out = []
+    for r1 in df1:
+        pt = r1['Pickticket']
+        inv, stat, err = by_ax.get(pt, no_ax)
+        pr, shs, shds, pmod, pcd, dd = by_pickroute.get(pt, no_pickroute)
+        proc = stat if stat is not None else sys.intern(r1.get('StatusSummary', ''))
+        # Decide on the joined values first; only rows that survive are built
+        if not (shds is None or proc is None or (shds == 'Picking List' and proc == 'AX Load Failure')):
+            continue
+        if pt in seen:
+            continue
+        seen.add(pt)
+        for c in INTERN_SHIP_COLUMNS:
+            r1[c] = sys.intern(r1[c])
+        out.append(get_ship(r1) + (
+            inv if inv is not None else r1.get('InvoiceNumber', ''),
+            proc,
+            err if err is not None else r1.get('ERRORDESCRIPTION', ''),
+            pr, shs, shds, pmod, pcd, dd,
+        ))
+
+    return out
+
+
+# ---------- Report cache ----------
+
+REPORT_CACHE_SIZE = 8
+_report_cache: "OrderedDict[str, List[ReportRow]]" = OrderedDict()
+
+EXPORT_CACHE_SIZE = 16
+_export_cache: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+
+# Endpoints fill the caches from worker threads
+_cache_lock = threading.Lock()
+
+EXPORT_MEDIA_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "pdf": "application/pdf",
+}
+
+
+def _cache_get(cache: OrderedDict, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache: OrderedDict, key, value, maxsize: int) -> None:
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > maxsize:
+            cache.popitem(last=False)
+
+
+def upload_digest(*uploads: UploadFile) -> str:
+    """Hash the upload bodies chunk by chunk; identical submissions share a key."""
+    h = hashlib.blake2b(digest_size=16)
+    for upload in uploads:
+        f = upload.file
+        f.seek(0)
+        part = hashlib.blake2b(digest_size=16)
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            part.update(chunk)
+        f.seek(0)
+        h.update(part.digest())
+    return h.hexdigest()
+
+
+def cached_report_rows(key: str, shipment_history: UploadFile, edib2bi: UploadFile, edi940: UploadFile) -> List[ReportRow]:
+    """build_report_rows, skipped entirely when the same uploads were seen recently."""
+    rows = _cache_get(_report_cache, key)
+    if rows is None:
+        rows = build_report_rows(shipment_history, edib2bi, edi940)
+        _cache_put(_report_cache, key, rows, REPORT_CACHE_SIZE)
+    return rows
+
+
+def cached_export_bytes(key: str, rows: List[ReportRow], format: str) -> bytes:
+    """Serialized report for one format, reused across endpoints and retries."""
+    data = _cache_get(_export_cache, (key, format))
+    if data is None:
+        if format == "xlsx":
+            data = to_xlsx_bytes(rows, REPORT_COLUMNS)
+        elif format == "csv":
+            data = to_csv_bytes(rows, REPORT_COLUMNS)
+        else:  # pdf
+            data = to_pdf_bytes(rows, REPORT_COLUMNS)
+        _cache_put(_export_cache, (key, format), data, EXPORT_CACHE_SIZE)
+    return data
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check; uses weak comparison as RFC 9110 requires for it."""
+    if not if_none_match:
+        return False
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+def report_rows_for(shipment_history: UploadFile, edib2bi: UploadFile, edi940: UploadFile) -> Tuple[str, List[ReportRow]]:
+    """Upload hash plus report rows; blocking, meant to run in the threadpool."""
+    key = upload_digest(shipment_history, edib2bi, edi940)
+    return key, cached_report_rows(key, shipment_history, edib2bi, edi940)
+
+
+# ---------- SMTP connection reuse ----------
+
+# One authenticated connection per worker, shared by threadpool threads and
+# guarded by _smtp_lock. _smtp_config is the (host, port, user, timeout) it
+# was opened with.
+_smtp: Optional[smtplib.SMTP] = None
+_smtp_config: Optional[Tuple[str, int, str, float]] = None
+_smtp_lock = threading.Lock()
 
-    return deduped
+
+def _smtp_reset() -> None:
+    """Drop the pooled connection; caller holds _smtp_lock."""
+    global _smtp, _smtp_config
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except Exception:
+            _smtp.close()
+    _smtp = None
+    _smtp_config = None
+
+
+def close_smtp() -> None:
+    with _smtp_lock:
+        _smtp_reset()
+
+
+def _smtp_send(msg: EmailMessage, host: str, port: int, user: str, password: str, timeout: float) -> None:
+    """Send over the pooled connection, (re)connecting and logging in as needed.
+
+    The socket timeout bounds every blocking call, so a half-open connection
+    fails the NOOP probe with OSError instead of hanging while the lock is held.
+    """
+    global _smtp, _smtp_config
+    config = (host, port, user, timeout)
+    with _smtp_lock:
+        if _smtp is not None and _smtp_config != config:
+            _smtp_reset()
+        if _smtp is not None:
+            try:
+                if _smtp.noop()[0] != 250:
+                    _smtp_reset()
+            except (smtplib.SMTPException, OSError):
+                _smtp_reset()
+        if _smtp is None:
+            server = smtplib.SMTP(host, port, timeout=timeout)
+            try:
+                server.starttls()
+                server.login(user, password)
+            except Exception:
+                server.close()
+                raise
+            _smtp, _smtp_config = server, config
+        try:
+            _smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            _smtp_reset()
+            raise
+        except smtplib.SMTPException:
+            # Per-message failure (e.g. refused recipients); the session is still usable
+            raise
+        except OSError:
+            _smtp_reset()
+            raise
 
 
 @app.get("/")
@@ -243,6 +494,7 @@ def root():
 
 @app.post("/reconcile")
 async def reconcile(
+    request: Request,
     shipment_history: UploadFile = File(..., description="Shipment_History___Total-*.csv"),
     edib2bi: UploadFile = File(..., description="EDIB2BiReportV2*.csv"),
     edi940: UploadFile = File(..., description="EDI940Report_withCostV2.0*.csv"),
@@ -252,41 +504,35 @@ async def reconcile(
     if format not in {"xlsx", "csv", "json", "pdf"}:
         raise HTTPException(status_code=400, detail="format must be one of xlsx,csv,json,pdf")
 
-    rows = build_report_rows(shipment_history, edib2bi, edi940)
-
-    # Determine final column order
-    columns = [
-        'Pickticket','Warehouse','Order','Drop Date','Ship Date','Ship To',
-        'Ship State','Zip Code','Customer PO','Ship Via','Load ID','Weight','SKU','Units','Price','Size Type','Size','Product Type',
-        'Received in EDI?','EDI Processing Status','EDI Message',
-        'Found in AX DATa?','SalesHeaderStatus','SalesHeaderDocStatus','PickModeOfDelivery','PickCreatedDate','DeliveryDate'
-    ]
+    key = await run_in_threadpool(upload_digest, shipment_history, edib2bi, edi940)
 
     stamp = datetime.datetime.now().strftime("%m%d%y")
     base_filename = f"MISSING_945_{stamp}"
 
+    # Same uploads, format and day give the same rows; let clients revalidate cheaply.
+    # xlsx/pdf embed creation timestamps, so their bytes only match semantically.
+    etag = f'"{key}-{format}-{stamp}"'
+    if format in {"xlsx", "pdf"}:
+        etag = "W/" + etag
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    rows = await run_in_threadpool(cached_report_rows, key, shipment_history, edib2bi, edi940)
+
     if format == "json":
-        return JSONResponse({
-            "filename": base_filename + ".json",
-            "rows": rows,
-        })
-
-    if format == "xlsx":
-        data = to_xlsx_bytes(rows, columns)
-        media = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        filename = base_filename + ".xlsx"
-    elif format == "csv":
-        data = to_csv_bytes(rows, columns)
-        media = "text/csv"
-        filename = base_filename + ".csv"
-    else:  # pdf
-        data = to_pdf_bytes(rows, columns)
-        media = "application/pdf"
-        filename = base_filename + ".pdf"
-
-    return StreamingResponse(io.BytesIO(data), media_type=media, headers={
-        "Content-Disposition": f'attachment; filename="{filename}"'
-    })
+        body = await run_in_threadpool(to_json_bytes, rows, REPORT_COLUMNS, base_filename + ".json")
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+    media = EXPORT_MEDIA_TYPES[format]
+    filename = f"{base_filename}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "ETag": etag}
+
+    if format == "csv":
+        # Stream straight from the rows rather than buffering the whole file
+        return StreamingResponse(iter_csv_chunks(rows, REPORT_COLUMNS), media_type=media, headers=headers)
+
+    data = await run_in_threadpool(cached_export_bytes, key, rows, format)
+    return StreamingResponse(io.BytesIO(data), media_type=media, headers=headers)
 
 
 @app.post("/send-report")
@@ -299,14 +545,7 @@ async def send_report(
     body: Optional[str] = Form(None),
     format: str = Form("xlsx"),
 ):
-    rows = build_report_rows(shipment_history, edib2bi, edi940)
-
-    columns = [
-        'Pickticket','Warehouse','Order','Drop Date','Ship Date','Ship To',
-        'Ship State','Zip Code','Customer PO','Ship Via','Load ID','Weight','SKU','Units','Price','Size Type','Size','Product Type',
-        'Received in EDI?','EDI Processing Status','EDI Message',
-        'Found in AX DATa?','SalesHeaderStatus','SalesHeaderDocStatus','PickModeOfDelivery','PickCreatedDate','DeliveryDate'
-    ]
+    key, rows = await run_in_threadpool(report_rows_for, shipment_history, edib2bi, edi940)
 
     format = (format or "xlsx").lower()
     if format not in {"xlsx", "csv", "pdf"}:
@@ -315,15 +554,8 @@ async def send_report(
     stamp = datetime.datetime.now().strftime("%m%d%y")
     filename = f"MISSING_945_{stamp}.{format}"
 
-    if format == "xlsx":
-        data = to_xlsx_bytes(rows, columns)
-        media = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    elif format == "csv":
-        data = to_csv_bytes(rows, columns)
-        media = "text/csv"
-    else:
-        data = to_pdf_bytes(rows, columns)
-        media = "application/pdf"
+    data = await run_in_threadpool(cached_export_bytes, key, rows, format)
+    media = EXPORT_MEDIA_TYPES[format]
 
     # Email configuration via environment
     smtp_host = os.getenv("SMTP_HOST")
@@ -331,9 +563,10 @@ async def send_report(
     smtp_user = os.getenv("SMTP_USER")
     smtp_pass = os.getenv("SMTP_PASS")
     smtp_from = os.getenv("SMTP_FROM", smtp_user or "noreply@example.com")
+    smtp_timeout = float(os.getenv("SMTP_TIMEOUT", "30"))
 
     if not smtp_host or not smtp_user or not smtp_pass:
-        raise HTTPException(status_code=500, detail="SMTP not configured. Set SMTP_HOST, SMTP_USER, SMTP_PASS (and optionally SMTP_PORT, SMTP_FROM)")
+        raise HTTPException(status_code=500, detail="SMTP not configured. Set SMTP_HOST, SMTP_USER, SMTP_PASS (and optionally SMTP_PORT, SMTP_FROM, SMTP_TIMEOUT)")
 
     msg = EmailMessage()
     msg["From"] = smtp_from
@@ -347,10 +580,7 @@ async def send_report(
     msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
 
     try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.send_message(msg)
+        await run_in_threadpool(_smtp_send, msg, smtp_host, smtp_port, smtp_user, smtp_pass, smtp_timeout)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to send email: {e}")
 